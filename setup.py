@@ -1,9 +1,25 @@
 
 from setuptools import setup, find_packages
+from setuptools.command.build_py import build_py
+import json
 import pathlib
+import yaml
 
 here = pathlib.Path(__file__).parent.resolve()
 
+
+class BuildPyWithApiCache(build_py):
+    """Additionally ship the API definition as JSON to avoid parsing YAML at runtime"""
+
+    def run(self):
+        super().run()
+        api_yaml = here / 'src' / 'wattpilot' / 'ressources' / 'wattpilot.yaml'
+        api_json = pathlib.Path(self.build_lib) / 'wattpilot' / 'ressources' / 'wattpilot.json'
+        with open(api_yaml, 'r', encoding='utf-8') as stream:
+            api_def = yaml.load(stream, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+        api_json.write_text(json.dumps(api_def), encoding='utf-8')
+
+
 # Get the long description from the README file
 long_description = (here / 'README.md').read_text(encoding='utf-8')
 
@@ -34,8 +50,10 @@ setup(
         'console_scripts': ['wattpilotshell=wattpilot.wattpilotshell:main'],
     },
     package_data = { '' : ['wattpilot.yaml'] },
+    cmdclass={'build_py': BuildPyWithApiCache},
     python_requires='>=3.10, <4',
     install_requires=['websocket-client','PyYAML','paho-mqtt','cmd2'],
+    extras_require={'orjson': ['orjson']},
     platforms="any",
     license="MIT License",
     project_urls={
@@ -310,6 +310,7 @@ class Wattpilot(object):
     def disconnect(self, auto_reconnect=False):
         self._wsapp.close()
         self._connected=False
+        self._connected_event.clear()
         self._auto_reconnect = auto_reconnect
         self.__call_event_handler(Event.WP_DISCONNECT)
         _LOGGER.info("Wattpilot disconnected")
@@ -508,6 +509,7 @@ class Wattpilot(object):
 
     def __on_AuthSuccess(self,message):
         self._connected = True
+        self._connected_event.set()
         self.__call_event_handler(Event.WP_AUTH_SUCCESS, message)
         _LOGGER.info("Authentication successful")
 
@@ -517,6 +519,10 @@ class Wattpilot(object):
             self.__update_property(key,props[key])
         self.__call_event_handler(Event.WP_FULL_STATUS, message)
         self._allPropsInitialized = not message.partial
+        if self._allPropsInitialized:
+            self._allPropsInitialized_event.set()
+        else:
+            self._allPropsInitialized_event.clear()
         if message.partial == False:
             self.__call_event_handler(Event.WP_FULL_STATUS_FINISHED, message)
 
@@ -557,6 +563,7 @@ class Wattpilot(object):
 
     def __on_close(self,wsapp,code,msg):
         self._connected=False
+        self._connected_event.clear()
         self.__call_event_handler(Event.WS_CLOSE, wsapp, code, msg)
         if (self._auto_reconnect):
             sleep(self._reconnect_interval)
@@ -609,8 +616,10 @@ class Wattpilot(object):
             self._url = "ws://"+ip+"/ws"
         self.serial = None
         self._connected = False
+        self._connected_event = threading.Event()
         self._allProps={}
         self._allPropsInitialized=False
+        self._allPropsInitialized_event = threading.Event()
         self._voltage1=None
         self._voltage2=None
         self._voltage3=None
@@ -1,45 +1,69 @@
 import cmd2
+import functools
+import hashlib
 import json
 import logging
 import math
 import os
 import paho.mqtt.client as mqtt
 import re
+import signal
 import sys
 import wattpilot
 import yaml
 import pkgutil
 
-from enum import Enum, auto
+from enum import Enum, IntEnum, auto
 from importlib.metadata import version
-from time import sleep
+from time import sleep, time
 from threading import Event
-from types import SimpleNamespace
+from types import MappingProxyType, SimpleNamespace
+
+try:
+    import orjson  # Optional: faster encoding of HA discovery payloads
+except ImportError:
+    orjson = None
 
 _LOGGER = logging.getLogger(__name__)
 
+# Prefer the libyaml based loader if available:
+_YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
 
 #### Utility Functions ####
 
 def utils_add_to_dict_unique(d, k, v):
     if k in d:
         _LOGGER.warning(
-            f"About to add duplicate key {k} to dictionary - skipping!")
+            "About to add duplicate key %s to dictionary - skipping!", k)
     else:
         d[k] = v
     return d
 
 
-def utils_wait_timeout(fn, timeout):
-    """Generic timeout waiter"""
-    t = 0
-    within_timeout = True
-    while not fn() and t < timeout:
-        sleep(1)
-        t += 1
-    if t >= timeout:
-        within_timeout = False
-    return within_timeout
+@functools.lru_cache(maxsize=256)
+def utils_compile_regex_ci(pattern):
+    """Compile a case-insensitive regex (cached independently of the re module cache)"""
+    return re.compile(pattern, flags=re.IGNORECASE)
+
+
+def utils_str2value(s):
+    """Convert a string from user input to a boolean, integer, float or string value"""
+    if s.lower() in ["false", "true"]:
+        return s.lower() == "true"
+    # NOTE: int() and float() accept digit grouping (e.g. 1_0), which is not meant as a number here:
+    if "_" in s:
+        return s
+    try:
+        return int(s)
+    except ValueError:
+        pass
+    try:
+        f = float(s)
+    except ValueError:
+        return s
+    # NOTE: Non-finite values (nan, inf) cannot be sent as valid JSON, so keep them as string:
+    return f if math.isfinite(f) else s
 
 
 class JSONNamespaceEncoder(json.JSONEncoder):
@@ -50,14 +74,73 @@ class JSONNamespaceEncoder(json.JSONEncoder):
         return super(JSONNamespaceEncoder, self).default(obj)
 
 
+# Shared encoder instance (encoding is stateless, so it can be reused):
+_JSON_ENCODER = JSONNamespaceEncoder()
+
+
 def utils_value2json(value):
-    return json.dumps(value, cls=JSONNamespaceEncoder)
+    return _JSON_ENCODER.encode(value)
+
+
+def _orjson_default(obj):
+    if isinstance(obj, SimpleNamespace):
+        return obj.__dict__
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+def utils_value2json_bytes(value):
+    """Encode a value as UTF-8 JSON bytes (using orjson if available)"""
+    if orjson is not None:
+        return orjson.dumps(value, default=_orjson_default)
+    return _JSON_ENCODER.encode(value).encode()
 
 
 #### Wattpilot Functions ####
 
-def wp_read_apidef():
+def wp_load_apidef_config():
+    # Prefer the pre-parsed JSON cache generated at build time (see setup.py):
+    try:
+        return json.loads(pkgutil.get_data(__name__, "ressources/wattpilot.json"))
+    except FileNotFoundError:
+        _LOGGER.debug("No JSON cache of the API definition found - parsing wattpilot.yaml ...")
     api_definition = pkgutil.get_data(__name__, "ressources/wattpilot.yaml")
+    return yaml.load(api_definition, Loader=_YAML_LOADER)
+
+
+class JsonType(IntEnum):
+    """JSON types of properties (stored as `_jt` in property definitions)"""
+    STRING = 0
+    INTEGER = 1
+    FLOAT = 2
+    BOOLEAN = 3
+    ARRAY = 4
+    OBJECT = 5
+
+
+_JSON_TYPES = {t.name.lower(): t for t in JsonType}
+
+# Encoding modes for property values (see mqtt_get_encoded_property):
+_ENCODE_RAW = 0
+_ENCODE_JSON = 1
+_ENCODE_BOOLEAN = 2
+_ENCODE_MODES = {JsonType.ARRAY: _ENCODE_JSON, JsonType.OBJECT: _ENCODE_JSON, JsonType.BOOLEAN: _ENCODE_BOOLEAN}
+
+
+def wp_precompute_property(pd):
+    """Add derived lookup fields to a property definition"""
+    pd["_jt"] = _JSON_TYPES.get(pd.get("jsonType"))  # None for unknown/unset types
+    pd["_encodeMode"] = _ENCODE_MODES.get(pd["_jt"], _ENCODE_RAW)
+    if "valueMap" in pd:
+        inverse = {}
+        for k, v in pd["valueMap"].items():
+            inverse.setdefault(v, k)
+        pd["_valueMapInverse"] = inverse
+    return pd
+
+
+@functools.lru_cache(maxsize=1)
+def wp_read_apidef():
+    """Read the API definition (parsed only once per process)"""
     wpdef = {
         "config": {},
         "messages": {},
@@ -65,17 +148,19 @@ def wp_read_apidef():
         "splitProperties": [],
     }
     try:
-        wpdef["config"] = yaml.safe_load(api_definition)
+        wpdef["config"] = wp_load_apidef_config()
         wpdef["messages"] = dict(zip(
             [x["key"] for x in wpdef["config"]["messages"]],
             [x for x in wpdef["config"]["messages"]],
         ))
         wpdef["properties"] = {}
         for p in wpdef["config"]["properties"]:
+            wp_precompute_property(p)
             wpdef["properties"] = utils_add_to_dict_unique(
                 wpdef["properties"], p["key"], p)
             if "childProps" in p and Cfg.WATTPILOT_SPLIT_PROPERTIES.val:
                 for cp in p["childProps"]:
+                    wp_precompute_property(cp)
                     cp = {
                         # Defaults for split properties:
                         "description": f"This is a child property of '{p['key']}'. See its description for more information.",
@@ -86,12 +171,27 @@ def wp_read_apidef():
                         "parentProperty": p["key"],
                         "rw": "R",  # NOTE: Split properties currently can only be read
                     }
-                    _LOGGER.debug(f"Adding child property {cp['key']}: {cp}")
+                    wp_precompute_property(cp)
+                    _LOGGER.debug("Adding child property %s: %s", cp['key'], cp)
                     wpdef["properties"] = utils_add_to_dict_unique(
                         wpdef["properties"], cp["key"], cp)
                     wpdef["splitProperties"].append(cp["key"])
-        _LOGGER.debug(
-            f"Resulting properties config:\n{utils_value2json(wpdef['properties'])}")
+        # Sorted keys for shell completion:
+        wpdef["propertyKeys"] = sorted(wpdef["properties"].keys())
+        wpdef["rwPropertyKeys"] = [k for k in wpdef["propertyKeys"]
+                                   if wpdef["properties"][k].get("rw") == "R/W"]
+        wpdef["messageKeys"] = sorted(wpdef["messages"].keys())
+        wpdef["messageKeysBySender"] = {}
+        for k in wpdef["messageKeys"]:
+            wpdef["messageKeysBySender"].setdefault(
+                wpdef["messages"][k]["sender"], []).append(k)
+        if _LOGGER.isEnabledFor(logging.DEBUG):
+            # Only encode the (large) properties config if it is actually logged:
+            _LOGGER.debug(
+                "Resulting properties config:\n%s", utils_value2json(wpdef['properties']))
+        # Protect the shared (cached) definitions against modifications:
+        wpdef["messages"] = MappingProxyType(wpdef["messages"])
+        wpdef["properties"] = MappingProxyType(wpdef["properties"])
     except yaml.YAMLError as exc:
         _LOGGER.fatal(exc)
     return wpdef
@@ -100,7 +200,7 @@ def wp_read_apidef():
 def wp_initialize(host, password):
     global wp
     # Connect to Wattpilot:
-    _LOGGER.debug(f"wp_initialize()")
+    _LOGGER.debug("wp_initialize()")
     wp = wattpilot.Wattpilot(host, password)
     wp._auto_reconnect = Cfg.WATTPILOT_AUTO_RECONNECT.val
     wp._reconnect_interval = Cfg.WATTPILOT_RECONNECT_INTERVAL.val
@@ -110,20 +210,20 @@ def wp_initialize(host, password):
 
 def wp_connect(wp, wait_for_timeouts=True):
     wp.connect()
-    # Wait for connection and initialization - TODO: Use event handler instead to make it more responsive!
+    # Wait for connection and initialization:
     if wait_for_timeouts:
-        utils_wait_timeout(lambda: wp.connected, Cfg.WATTPILOT_CONNECT_TIMEOUT.val) or exit(
+        wp._connected_event.wait(Cfg.WATTPILOT_CONNECT_TIMEOUT.val) or exit(
             "ERROR: Timeout while connecting to Wattpilot!")
-        utils_wait_timeout(lambda: wp.allPropsInitialized, Cfg.WATTPILOT_INIT_TIMEOUT.val) or exit(
+        wp._allPropsInitialized_event.wait(Cfg.WATTPILOT_INIT_TIMEOUT.val) or exit(
             "ERROR: Timeout while waiting for property initialization!")
     return wp
 
 
 def wp_handle_events(event, *args):
     global mqtt_client
-    _LOGGER.debug(f"wp_handle_events(event={event},{args})")
+    _LOGGER.debug("wp_handle_events(event=%s,%s)", event, args)
     if not mqtt_client:
-        _LOGGER.debug(f"wp_handle_events(): MQTT client not yet initialized - status publishing skipped.")
+        _LOGGER.debug("wp_handle_events(): MQTT client not yet initialized - status publishing skipped.")
         return
     available_topic = mqtt_subst_topic(Cfg.MQTT_TOPIC_AVAILABLE.val, {})
     if event['type'] == 'on_close':
@@ -137,30 +237,30 @@ def wp_get_child_prop_value(cp):
     cpd = wpdef["properties"][cp]
     if "parentProperty" not in cpd:
         _LOGGER.warning(
-            f"Child property '{cpd['key']}' is not linked to a parent property: {cpd}")
+            "Child property '%s' is not linked to a parent property: %s", cpd['key'], cpd)
         return None
     ppd = wpdef["properties"][cpd["parentProperty"]]
     parent_value = wp.allProps[ppd["key"]]
     value = None
-    if ppd["jsonType"] == "array":
+    if ppd["_jt"] is JsonType.ARRAY:
         value = parent_value[int(cpd["valueRef"])] if int(
             cpd["valueRef"]) < len(parent_value) else None
-        _LOGGER.debug(f"  -> got array value {value}")
-    elif ppd["jsonType"] == "object":
+        _LOGGER.debug("  -> got array value %s", value)
+    elif ppd["_jt"] is JsonType.OBJECT:
         if parent_value == None:
             value = None
-            _LOGGER.debug(f"  -> parent value is None, so child as well")
+            _LOGGER.debug("  -> parent value is None, so child as well")
         elif isinstance(parent_value, SimpleNamespace) and cpd["valueRef"] in parent_value.__dict__:
             value = parent_value.__dict__[cpd["valueRef"]]
-            _LOGGER.debug(f"  -> got object value {value}")
+            _LOGGER.debug("  -> got object value %s", value)
         elif cpd["valueRef"] in parent_value:
             value = parent_value[cpd["valueRef"]]
-            _LOGGER.debug(f"  -> got object value {value}")
+            _LOGGER.debug("  -> got object value %s", value)
         else:
             _LOGGER.warning(
-                f"Unable to map child property {cpd['key']}: type={type(parent_value)}, value={utils_value2json(parent_value)}")
+                "Unable to map child property %s: type=%s, value=%s", cpd['key'], type(parent_value), utils_value2json(parent_value))
     else:
-        _LOGGER.warning(f"Property {ppd['key']} cannot be split!")
+        _LOGGER.warning("Property %s cannot be split!", ppd['key'])
     return value
 
 
@@ -199,14 +299,27 @@ class WattpilotShell(cmd2.Cmd):
     def emptyline(self) -> bool:
         return False
 
+    def _split_args(self, arg, min_args, max_args=None):
+        """Split command arguments (the last one takes the rest of the line) or return None, if too few are given"""
+        args = arg.split(maxsplit=(max_args or min_args)-1)
+        return args if len(args) >= min_args else None
+
     def _complete_list(self, clist, text):
         return [x for x in clist if x.startswith(text)]
 
     def _complete_message(self, text, sender=None):
-        return [md["key"] for md in self.wpdef["messages"].values() if (not sender or md["sender"] == sender) and md["key"].startswith(text)]
+        keys = self.wpdef["messageKeysBySender"].get(sender, []) if sender else self.wpdef["messageKeys"]
+        return [k for k in keys if k.startswith(text)]
 
     def _complete_propname(self, text, rw=False, available_only=True):
-        return [k for k in wp_get_all_props(available_only).keys() if (not rw or ("rw" in self.wpdef["properties"][k] and self.wpdef["properties"][k]["rw"] == "R/W")) and k.startswith(text)]
+        if not available_only:
+            return [k for k in self.wpdef["rwPropertyKeys" if rw else "propertyKeys"] if k.startswith(text)]
+        keys = [k for k in self.wp.allProps if k.startswith(text)]
+        if Cfg.WATTPILOT_SPLIT_PROPERTIES.val:
+            keys += [k for k in self.wpdef["splitProperties"] if k.startswith(text)]
+        if rw:
+            keys = [k for k in keys if self.wpdef["properties"].get(k, {}).get("rw") == "R/W"]
+        return keys
 
     def _complete_values(self, text, line):
         token = line.split(' ')
@@ -250,10 +363,10 @@ Usage: exit"""
     def do_propget(self, arg: str) -> bool | None:
         """Get a property value
 Usage: propget <propName>"""
-        args = arg.split(' ')
+        args = self._split_args(arg, 1)
         if not self._ensure_connected():
             return
-        if len(args) < 1 or arg == '':
+        if args is None:
             print(f"ERROR: Wrong number of arguments!")
         elif args[0] in self.wp.allProps:
             pd = self.wpdef["properties"][args[0]]
@@ -293,10 +406,10 @@ Home Assistant commands:
     NOTE: Removing of disabled entities may still be broken in HA and require a restart of HA.
 """
         global mqtt_client
-        args = arg.split(' ')
+        args = self._split_args(arg, 1, 2)
         if not self._ensure_connected():
             return
-        if len(args) < 1 or arg == '':
+        if args is None:
             print(f"ERROR: Wrong number of arguments!")
             return
         if args[0] == "properties":
@@ -317,33 +430,41 @@ Home Assistant commands:
             print(f"ERROR: Unsupported argument: {args[0]}")
 
     def _ha_prop_cmds(self, cmd, prop_name):
-        global mqtt_client
         if prop_name not in wpdef["properties"]:
             print(f"ERROR: Unknown property '{prop_name}!")
         elif cmd == "enable":
             if prop_name not in Cfg.MQTT_PROPERTIES.val:
                 Cfg.MQTT_PROPERTIES.val.append(prop_name)
-            ha_discover_property(
-                self.wp, mqtt_client, self.wpdef["properties"][prop_name], disable_discovery=False, force_enablement=True)
+            self._ha_discover_prop(prop_name, disable_discovery=False, force_enablement=True)
         elif cmd == "disable":
             if prop_name in Cfg.MQTT_PROPERTIES.val:
                 Cfg.MQTT_PROPERTIES.val.remove(prop_name)
-            ha_discover_property(
-                self.wp, mqtt_client, self.wpdef["properties"][prop_name], disable_discovery=False, force_enablement=False)
+            self._ha_discover_prop(prop_name, disable_discovery=False, force_enablement=False)
         elif cmd == "discover":
             if prop_name not in Cfg.HA_PROPERTIES.val:
                 Cfg.HA_PROPERTIES.val.append(prop_name)
             if prop_name not in Cfg.MQTT_PROPERTIES.val:
                 Cfg.MQTT_PROPERTIES.val.append(prop_name)
-            ha_discover_property(
-                self.wp, mqtt_client, self.wpdef["properties"][prop_name], disable_discovery=False, force_enablement=True)
+            self._ha_discover_prop(prop_name, disable_discovery=False, force_enablement=True)
         elif cmd == "undiscover":
             if prop_name in Cfg.HA_PROPERTIES.val:
                 Cfg.HA_PROPERTIES.val.remove(prop_name)
             if prop_name in Cfg.MQTT_PROPERTIES.val:
                 Cfg.MQTT_PROPERTIES.val.remove(prop_name)
+            self._ha_discover_prop(prop_name, disable_discovery=True, force_enablement=False)
+
+    def _ha_discover_prop(self, prop_name, disable_discovery, force_enablement):
+        global mqtt_client
+        if Cfg.HA_DEVICE_DISCOVERY.val and not disable_discovery and prop_name not in Cfg.HA_PROPERTIES.val:
+            print(f"ERROR: Property '{prop_name}' is not discovered - use 'ha discover {prop_name}' first!")
+        elif Cfg.HA_DEVICE_DISCOVERY.val:
+            # The device config always contains all components:
+            ha_discover_device(self.wp, mqtt_client, Cfg.HA_PROPERTIES.val,
+                               removed_properties=[prop_name] if disable_discovery else [],
+                               force_enablement={prop_name: force_enablement})
+        else:
             ha_discover_property(
-                self.wp, mqtt_client, self.wpdef["properties"][prop_name], disable_discovery=True, force_enablement=False)
+                self.wp, mqtt_client, self.wpdef["properties"][prop_name], disable_discovery, force_enablement)
 
     def complete_ha(self, text, line, begidx, endidx):
         token = line.split(' ')
@@ -389,10 +510,10 @@ MQTT commands:
     Disable publishing of a certain property
 """
         global mqtt_client
-        args = arg.split(' ')
+        args = self._split_args(arg, 1, 2)
         if not self._ensure_connected():
             return
-        if len(args) < 1 or arg == '':
+        if args is None:
             print(f"ERROR: Wrong number of arguments!")
             return
         if args[0] == "properties":
@@ -441,7 +562,7 @@ Usage: properties [propRegex]"""
             print(f"No matching properties found!")
             return
         print(f"Properties:")
-        for prop_name, value in sorted(props.items()):
+        for prop_name, value in props.items():
             self._print_prop_info(self.wpdef["properties"][prop_name], value)
         print()
 
@@ -455,7 +576,7 @@ Usage: rawvalues [propRegex] [valueRegex]"""
             return
         print(f"List raw values of properties (without value mapping):")
         props = self._get_props_matching_regex(arg)
-        for pd, value in sorted(props.items()):
+        for pd, value in props.items():
             print(f"- {pd}: {utils_value2json(value)}")
         print()
 
@@ -477,24 +598,16 @@ Usage: server"""
     def do_propset(self, arg: str) -> bool | None:
         """Set a property value
 Usage: propset <propName> <value>"""
-        args = arg.split(' ')
+        args = self._split_args(arg, 2)
         if not self._ensure_connected():
             return
-        if len(args) < 2 or arg == '':
+        if args is None:
             print(f"ERROR: Wrong number of arguments!")
         elif args[0] not in wp.allProps:
             print(f"ERROR: Unknown property: {args[0]}")
         else:
-            if args[1].lower() in ["false", "true"]:
-                v = json.loads(args[1].lower())
-            elif str(args[1]).isnumeric():
-                v = int(args[1])
-            elif str(args[1]).isdecimal():
-                v = float(args[1])
-            else:
-                v = str(args[1])
             wp.send_update(args[0], mqtt_get_decoded_property(
-                self.wpdef["properties"][args[0]], v))
+                self.wpdef["properties"][args[0]], utils_str2value(args[1])))
 
     def do_UpdateInverter(self, arg: str) -> bool | None:
         """Performs an Inverter Operation
@@ -502,10 +615,10 @@ Usage: updateInverter pair|unpair <inverterID>
 <inverterID> is normally in the form 123.456789"""
         global wp
         global wpdef
-        args = arg.split(' ')
+        args = self._split_args(arg, 2)
         if not self._ensure_connected():
             return
-        if len(args) < 2 or arg == '':
+        if args is None:
             print(f"ERROR: Wrong number of arguments!")
         elif args[0] not in ["pair", "unpair"]:
             print(f"ERROR: Unknown Operation: {args[0]}")
@@ -522,7 +635,7 @@ Usage: updateInverter pair|unpair <inverterID>
             return self._complete_propname(text, rw=True, available_only=True)
         elif len(token) == 3 and token[1] in self.wpdef["properties"]:
             pd = self.wpdef["properties"][token[1]]
-            if "jsonType" in pd and pd["jsonType"] == 'boolean':
+            if pd.get("_jt") is JsonType.BOOLEAN:
                 return [v for v in ['false', 'true'] if v.startswith(text)]
             elif "valueMap" in pd:
                 return [v for v in pd["valueMap"].values() if v.startswith(text)]
@@ -533,8 +646,8 @@ Usage: updateInverter pair|unpair <inverterID>
     def do_unwatch(self, arg: str) -> bool | None:
         """Unwatch a message or property
 Usage: unwatch <event|message|property> <eventType|msgType|propName>"""
-        args = arg.split(' ')
-        if len(args) < 2 or arg == '':
+        args = self._split_args(arg, 2)
+        if args is None:
             print(f"ERROR: Wrong number of arguments!")
         elif args[0] == 'event' and args[1] not in [e.name for e in list(wattpilot.Event)]:
             print(f"ERROR: Event of type '{args[1]}' is not watched")
@@ -574,7 +687,7 @@ Usage: values [propRegex] [valueRegex]"""
             return
         print(f"List values of properties (with value mapping):")
         props = self._get_props_matching_regex(arg)
-        for pd, value in sorted(props.items()):
+        for pd, value in props.items():
             print(
                 f"- {pd}: {mqtt_get_encoded_property(self.wpdef['properties'][pd],value)}")
         print()
@@ -585,8 +698,8 @@ Usage: values [propRegex] [valueRegex]"""
     def do_watch(self, arg: str) -> bool | None:
         """Watch an event, a message or a property
 Usage: watch <event|message|property> <eventType|msgType|propName>"""
-        args = arg.split(' ')
-        if len(args) < 2 or arg == '':
+        args = self._split_args(arg, 2)
+        if args is None:
             print(f"ERROR: Wrong number of arguments!")
         elif args[0] == 'event' and args[1] not in [e.name for e in list(wattpilot.Event)]:
             print(f"ERROR: Unknown event type: {args[1]}")
@@ -624,7 +737,7 @@ Usage: watch <event|message|property> <eventType|msgType|propName>"""
         return []
 
     def _print_prop_info(self, pd, value):
-        _LOGGER.debug(f"Property definition: {pd}")
+        _LOGGER.debug("Property definition: %s", pd)
         title = ""
         desc = ""
         alias = ""
@@ -654,12 +767,12 @@ Usage: watch <event|message|property> <eventType|msgType|propName>"""
         if name in self.watching_properties:
             pd = self.wpdef["properties"][name]
             _LOGGER.info(
-                f"Property {name} changed to {mqtt_get_encoded_property(pd,value)}")
+                "Property %s changed to %s", name, mqtt_get_encoded_property(pd,value))
 
     def _watched_message_received(self, event, message):
         msg_dict = json.loads(message)
         if msg_dict["type"] in self.watching_messages:
-            _LOGGER.info(f"Message of type {msg_dict['type']} received: {message}")
+            _LOGGER.info("Message of type %s received: %s", msg_dict['type'], message)
 
     def _ensure_connected(self):
         if not self.wp or not self.wp._connected:
@@ -668,37 +781,50 @@ Usage: watch <event|message|property> <eventType|msgType|propName>"""
         return True
 
     def _get_props_matching_regex(self, arg, available_only=True):
-        args = arg.split(' ')
+        args = self._split_args(arg, 0, 2)
         prop_regex = '.*'
-        if len(args) > 0 and args[0] != '':
+        if len(args) > 0:
             prop_regex = args[0]
-        props = {k: v for k, v in wp_get_all_props(available_only).items() if re.match(
-            r'^'+prop_regex+'$', k, flags=re.IGNORECASE)}
         value_regex = '.*'
         if len(args) > 1:
             value_regex = args[1]
-        props = {k: v for k, v in props.items() if re.match(r'^'+value_regex+'$',
-                                                            str(mqtt_get_encoded_property(self.wpdef["properties"][k], v)), flags=re.IGNORECASE)}
+        # Iterate over the pre-sorted property keys to return props in sorted order:
+        all_props = wp_get_all_props(available_only)
+        prop_pattern = utils_compile_regex_ci(r'^'+prop_regex+'$')
+        props = {k: all_props[k] for k in self.wpdef["propertyKeys"]
+                 if k in all_props and prop_pattern.match(k)}
+        if value_regex == '.*':
+            # No value filter given -> skip encoding all values:
+            return props
+        value_pattern = utils_compile_regex_ci(r'^'+value_regex+'$')
+        props = {k: v for k, v in props.items() if value_pattern.match(
+            str(mqtt_get_encoded_property(self.wpdef["properties"][k], v)))}
         return props
 
 
 #### MQTT Functions ####
 
+# Sentinel for missing dictionary entries:
+_MISSING = object()
+# Time to wait for pending messages to reach the broker before disconnecting:
+MQTT_STOP_TIMEOUT_S = 2
+
+
 def mqtt_get_mapped_value(pd, value):
     mapped_value = value
     if value == None:
         mapped_value = None
     elif "valueMap" in pd:
-        if str(value) in list(pd["valueMap"].keys()):
-            mapped_value = pd["valueMap"][str(value)]
-        else:
+        mapped_value = pd["valueMap"].get(str(value), _MISSING)
+        if mapped_value is _MISSING:
+            mapped_value = value
             _LOGGER.warning(
-                f"Unable to map value '{value}' of property '{pd['key']} - using unmapped value!")
+                "Unable to map value '%s' of property '%s - using unmapped value!", value, pd['key'])
     return mapped_value
 
 
 def mqtt_get_mapped_property(pd, value):
-    if value and "jsonType" in pd and pd["jsonType"] == "array":
+    if value and pd.get("_jt") is JsonType.ARRAY:
         mapped_value = []
         for v in value:
             mapped_value.append(mqtt_get_mapped_value(pd, v))
@@ -710,17 +836,17 @@ def mqtt_get_mapped_property(pd, value):
 def mqtt_get_remapped_value(pd, mapped_value):
     remapped_value = mapped_value
     if "valueMap" in pd:
-        if mapped_value in pd["valueMap"].values():
-            remapped_value = json.loads(str(list(pd["valueMap"].keys())[
-                                        list(pd["valueMap"].values()).index(mapped_value)]))
+        k = pd["_valueMapInverse"].get(mapped_value, _MISSING)
+        if k is not _MISSING:
+            remapped_value = json.loads(str(k))
         else:
             _LOGGER.warning(
-                f"Unable to remap value '{mapped_value}' of property '{pd['key']} - using mapped value!")
+                "Unable to remap value '%s' of property '%s - using mapped value!", mapped_value, pd['key'])
     return remapped_value
 
 
 def mqtt_get_remapped_property(pd, mapped_value):
-    if "jsonType" in pd and pd["jsonType"] == "array":
+    if pd.get("_jt") is JsonType.ARRAY:
         remapped_value = []
         for v in mapped_value:
             remapped_value.append(mqtt_get_remapped_value(pd, v))
@@ -731,86 +857,126 @@ def mqtt_get_remapped_property(pd, mapped_value):
 
 def mqtt_get_encoded_property(pd, value):
     mapped_value = mqtt_get_mapped_property(pd, value)
-    if value == None or "jsonType" in pd and (
-            pd["jsonType"] == "array"
-            or pd["jsonType"] == "object"
-            or pd["jsonType"] == "boolean"):
-        return json.dumps(mapped_value, cls=JSONNamespaceEncoder)
+    encode_mode = pd.get("_encodeMode", _ENCODE_RAW)
+    if encode_mode == _ENCODE_BOOLEAN and type(mapped_value) is bool:
+        return "true" if mapped_value else "false"
+    elif value == None or encode_mode != _ENCODE_RAW:
+        return _JSON_ENCODER.encode(mapped_value)
     else:
         return mapped_value
 
 
 def mqtt_get_decoded_property(pd, value):
-    if "jsonType" in pd and (pd["jsonType"] == "array" or pd["jsonType"] == "object"):
+    if pd.get("_encodeMode") == _ENCODE_JSON:
         decoded_value = json.loads(value)
     else:
         decoded_value = value
     return mqtt_get_remapped_property(pd, decoded_value)
 
 
-def mqtt_publish_property(wp, mqtt_client, pd, value, force_publish=False):
+def mqtt_get_publish_settings():
+    """Read the settings needed for publishing properties (to be hoisted out of loops)"""
+    # NOTE: A frozenset snapshot turns the per-property membership test into a hash lookup:
+    return (frozenset(Cfg.MQTT_PROPERTIES.val), Cfg.WATTPILOT_SPLIT_PROPERTIES.val)
+
+
+def mqtt_get_property_publications(wp, pd, value, force_publish=False, settings=None):
+    """Collect (topic, payload) tuples to publish for a property and its child properties"""
+    watched_properties, split_properties = settings or mqtt_get_publish_settings()
     prop_name = pd["key"]
-    if not (force_publish or not Cfg.MQTT_PROPERTIES.val or prop_name in Cfg.MQTT_PROPERTIES.val):
-        _LOGGER.debug(f"Skipping publishing of property '{prop_name}' ...")
-        return
-    property_topic = mqtt_subst_topic(Cfg.MQTT_TOPIC_PROPERTY_STATE.val, {
-        "baseTopic": Cfg.MQTT_TOPIC_BASE.val,
-        "serialNumber": wp.serial,
-        "propName": prop_name,
-    })
+    if not (force_publish or not watched_properties or prop_name in watched_properties):
+        _LOGGER.debug("Skipping publishing of property '%s' ...", prop_name)
+        return []
     encoded_value = mqtt_get_encoded_property(pd, value)
     _LOGGER.debug(
-        f"Publishing property '{prop_name}' with value '{encoded_value}' to MQTT ...")
-    mqtt_client.publish(property_topic, encoded_value, retain=True)
-    if Cfg.WATTPILOT_SPLIT_PROPERTIES.val and "childProps" in pd:
+        "Publishing property '%s' with value '%s' to MQTT ...", prop_name, encoded_value)
+    publications = [(mqtt_property_state_topic(prop_name), encoded_value)]
+    if split_properties and "childProps" in pd:
         _LOGGER.debug(
-            f"Splitting child props of property {prop_name} as {pd['jsonType']} for value {value} ...")
+            "Splitting child props of property %s as %s for value %s ...", prop_name, pd['jsonType'], value)
+        # Child properties are always published together with their parent:
         for cpd in pd["childProps"]:
-            _LOGGER.debug(f"Extracting child property {cpd['key']},  ...")
             split_value = wp_get_child_prop_value(cpd['key'])
             _LOGGER.debug(
-                f"Publishing sub-property {cpd['key']} with value {split_value} to MQTT ...")
-            mqtt_publish_property(wp, mqtt_client, cpd, split_value, True)
+                "Publishing sub-property %s with value %s to MQTT ...", cpd['key'], split_value)
+            publications.append((mqtt_property_state_topic(cpd['key']),
+                                 mqtt_get_encoded_property(cpd, split_value)))
+    return publications
+
+
+def mqtt_publish_batch(mqtt_client, publications):
+    # Publish collected (topic, payload) tuples back-to-back:
+    # NOTE: The network loop is intentionally kept running - paho only queues the packets for the loop thread
+    #       to drain, whereas publishing with a stopped loop writes every single packet synchronously.
+    publish = mqtt_client.publish
+    for topic, payload in publications:
+        publish(topic, payload, retain=True)
 
 
 def mqtt_publish_message(event, message):
-    _LOGGER.debug(f"""mqtt_publish_message(event={event},message={message})""")
+    _LOGGER.debug("mqtt_publish_message(event=%s,message=%s)", event, message)
+    global mqtt_client
+    global mqtt_message_topic
+    if mqtt_client == None or not Cfg.MQTT_PUBLISH_MESSAGES.val:
+        _LOGGER.debug("Skipping MQTT message publishing.")
+        return
+    msg_dict = json.loads(message)
+    if not Cfg.MQTT_MESSAGES.val or msg_dict["type"] in Cfg.MQTT_MESSAGES.val:
+        mqtt_client.publish(mqtt_message_topic(msg_dict["type"]), message)
+
+
+def mqtt_publish_status(event, message):
+    # Uses the message already parsed by the Wattpilot client (fullStatus/deltaStatus):
     global mqtt_client
     global wpdef
     wp = event['wp']
-    if mqtt_client == None:
-        _LOGGER.debug(f"Skipping MQTT message publishing.")
+    if mqtt_client == None or not Cfg.MQTT_PUBLISH_PROPERTIES.val:
+        _LOGGER.debug("Skipping MQTT property publishing.")
         return
-    msg_dict = json.loads(message)
-    if Cfg.MQTT_PUBLISH_MESSAGES.val and (not Cfg.MQTT_MESSAGES.val or msg_dict["type"] in Cfg.MQTT_MESSAGES.val):
-        message_topic = mqtt_subst_topic(Cfg.MQTT_TOPIC_MESSAGES.val, {
-            "baseTopic": Cfg.MQTT_TOPIC_BASE.val,
-            "serialNumber": wp.serial,
-            "messageType": msg_dict["type"],
-        })
-        mqtt_client.publish(message_topic, message)
-    if Cfg.MQTT_PUBLISH_PROPERTIES.val and msg_dict["type"] in ["fullStatus", "deltaStatus"]:
-        for prop_name, value in msg_dict["status"].items():
-            pd = wpdef["properties"][prop_name]
-            mqtt_publish_property(wp, mqtt_client, pd, value)
+    publications = []
+    settings = mqtt_get_publish_settings()
+    properties = wpdef["properties"]
+    for prop_name, value in vars(message.status).items():
+        publications += mqtt_get_property_publications(
+            wp, properties[prop_name], value, settings=settings)
+    mqtt_publish_batch(mqtt_client, publications)
 
 # Substitute topic patterns
 
 
+def mqtt_expand_topic(s):
+    if s.startswith('~'):
+        s = Cfg.MQTT_TOPIC_PROPERTY_BASE.val + s[1:]
+    return s
+
+
 def mqtt_subst_topic(s, values, expand=True):
     if expand:
-        s = re.sub(r'^~', Cfg.MQTT_TOPIC_PROPERTY_BASE.val, s)
-    all_values = {
-        "baseTopic": Cfg.MQTT_TOPIC_BASE.val,
-    } | values
-    return s.format(**all_values)
+        s = mqtt_expand_topic(s)
+    # NOTE: Adds baseTopic to the passed values (unless already set) to avoid copying them:
+    values.setdefault("baseTopic", Cfg.MQTT_TOPIC_BASE.val)
+    return s.format_map(values)
+
+
+def mqtt_compile_topic(s, values, field):
+    """Compile a topic pattern into a function only substituting the given field"""
+    s = mqtt_expand_topic(s)
+    values.setdefault("baseTopic", Cfg.MQTT_TOPIC_BASE.val)
+    placeholder = "{" + field + "}"
+    prefix, sep, suffix = s.partition(placeholder)
+    if sep and placeholder not in suffix:
+        # Format the static parts once and concatenate them on each call:
+        prefix = prefix.format_map(values)
+        suffix = suffix.format_map(values)
+        return lambda value: prefix + value + suffix
+    return lambda value: s.format_map(values | {field: value})
 
 
 def mqtt_setup_client(host, port, client_id, available_topic, command_topic, username="", password=""):
     # Connect to MQTT server:
     mqtt_client = mqtt.Client(client_id)
     mqtt_client.on_message = mqtt_set_value
-    _LOGGER.info(f"Connecting to MQTT host {host} on port {port} ...")
+    _LOGGER.info("Connecting to MQTT host %s on port %s ...", host, port)
     mqtt_client.will_set(
         available_topic, payload="offline", qos=0, retain=True)
     if username != "":
@@ -818,13 +984,26 @@ def mqtt_setup_client(host, port, client_id, available_topic, command_topic, use
     mqtt_client.connect(host, port)
     mqtt_client.loop_start()
     mqtt_client.publish(available_topic, payload="online", qos=0, retain=True)
-    _LOGGER.info(f"Subscribing to command topics {command_topic}")
+    _LOGGER.info("Subscribing to command topics %s", command_topic)
     mqtt_client.subscribe(command_topic)
     return mqtt_client
 
 
 def mqtt_setup(wp):
-    _LOGGER.debug(f"mqtt_setup(wp)")
+    global mqtt_message_topic
+    global mqtt_property_state_topic
+    global mqtt_set_topic_regex
+    _LOGGER.debug("mqtt_setup(wp)")
+
+    # Compile the property state topic only once:
+    mqtt_property_state_topic = mqtt_compile_topic(
+        Cfg.MQTT_TOPIC_PROPERTY_STATE.val, {"serialNumber": wp.serial}, "propName")
+    mqtt_message_topic = mqtt_compile_topic(
+        Cfg.MQTT_TOPIC_MESSAGES.val, {"serialNumber": wp.serial}, "messageType")
+
+    # Compile the regex to extract property names from set topics only once:
+    mqtt_set_topic_regex = re.compile('^' + mqtt_subst_topic(
+        Cfg.MQTT_TOPIC_PROPERTY_SET.val, {"propName": "([^/]+)"}) + '$')
 
     # Connect to MQTT server:
     mqtt_client = mqtt_setup_client(Cfg.MQTT_HOST.val, Cfg.MQTT_PORT.val, Cfg.MQTT_CLIENT_ID.val,
@@ -836,44 +1015,62 @@ def mqtt_setup(wp):
                                     )
     Cfg.MQTT_PROPERTIES.val = mqtt_get_watched_properties(wp)
     _LOGGER.info(
-        f"Registering message callback to publish updates to the following properties to MQTT: {Cfg.MQTT_PROPERTIES.val}")
+        "Registering message callback to publish updates to the following properties to MQTT: %s", Cfg.MQTT_PROPERTIES.val)
     wp.add_event_handler(wattpilot.Event.WS_MESSAGE, mqtt_publish_message)
+    wp.add_event_handler(wattpilot.Event.WP_FULL_STATUS, mqtt_publish_status)
+    wp.add_event_handler(wattpilot.Event.WP_DELTA_STATUS, mqtt_publish_status)
     return mqtt_client
 
 
+def mqtt_wait_for_publish(msg_infos, timeout):
+    """Wait until all messages (published with qos>0) are acknowledged - returns False on timeout or errors"""
+    deadline = time() + timeout
+    for msg_info in msg_infos:
+        try:
+            msg_info.wait_for_publish(max(0, deadline - time()))
+        except (RuntimeError, ValueError) as e:
+            _LOGGER.warning("Unable to publish MQTT message %s: %s", msg_info.mid, e)
+            return False
+        if not msg_info.is_published():
+            return False
+    return True
+
+
 def mqtt_stop(mqtt_client):
     if mqtt_client.is_connected():
-        _LOGGER.info(f"Disconnecting from MQTT server ...")
+        # The last will is not sent on regular disconnects, so announce the offline state explicitly:
+        msg_info = mqtt_client.publish(mqtt_subst_topic(Cfg.MQTT_TOPIC_AVAILABLE.val, {}),
+                                       payload=Cfg.MQTT_NOT_AVAILABLE_PAYLOAD.val, qos=1, retain=True)
+        if not mqtt_wait_for_publish([msg_info], MQTT_STOP_TIMEOUT_S):
+            _LOGGER.warning("Timeout while waiting for pending MQTT messages to be published!")
+        _LOGGER.info("Disconnecting from MQTT server ...")
         mqtt_client.disconnect()
+    mqtt_client.loop_stop()
 
 # Subscribe to topic for setting property values:
 
 
 def mqtt_set_value(client, userdata, message):
     global wpdef
-    topic_regex = mqtt_subst_topic(
-        Cfg.MQTT_TOPIC_PROPERTY_SET.val, {"propName": "([^/]+)"})
-    name = re.sub(topic_regex, r'\1', message.topic)
-    if not name or name == "" or not wpdef["properties"][name]:
-        _LOGGER.warning(f"Unknown property '{name}'!")
+    m = mqtt_set_topic_regex.match(message.topic)
+    if not m:
+        # E.g. late retained messages of temporary subscriptions after their callback has been removed:
+        _LOGGER.debug("Ignoring message on unrelated topic %s", message.topic)
+        return
+    name = m.group(1)
+    if name not in wpdef["properties"]:
+        _LOGGER.warning("Unknown property '%s'!", name)
+        return
     pd = wpdef["properties"][name]
     if pd['rw'] == "R":
-        _LOGGER.warning(f"Property '{name}' is not writable!")
+        _LOGGER.warning("Property '%s' is not writable!", name)
     #try:
     #    value = int(mqtt_get_decoded_property(pd, str(message.payload.decode("utf-8"))))
     #except ValueError:
-    value = str(message.payload.decode("utf-8"))
-    if value.lower() in ["false", "true"]:
-        v = json.loads(value.lower())
-    elif str(value).isnumeric():
-        v = int(value)
-    elif str(value).isdecimal():
-        v = float(value)
-    else:
-        v = str(args[1])
+    v = utils_str2value(message.payload.decode("utf-8"))
     value = mqtt_get_decoded_property(pd, v)
     _LOGGER.info(
-        f"MQTT Message received: topic={message.topic}, name={name}, value={value}")
+        "MQTT Message received: topic=%s, name=%s, value=%s", message.topic, name, value)
     wp.send_update(name, v)
 
 
@@ -886,6 +1083,13 @@ def mqtt_get_watched_properties(wp):
 
 #### Home Assistant Functions ####
 
+# Time to wait for retained discovery configs after subscribing:
+HA_RETAINED_CONFIGS_WAIT_S = 0.3
+# Payload of the Home Assistant birth message:
+HA_STATUS_ONLINE_PAYLOAD = b"online"
+# Payload handing over a per-entity discovery config to a device based one:
+HA_MIGRATE_DISCOVERY_PAYLOAD = b'{"migrate_discovery": true}'
+
 # Generate device information for HA discovery
 def ha_get_device_info(wp):
     ha_device = {
@@ -907,30 +1111,28 @@ def ha_get_device_info(wp):
     return ha_device
 
 
+# HA components by JSON type for writable and read-only properties:
+_HA_RW_COMPONENTS = {JsonType.BOOLEAN: "switch", JsonType.FLOAT: "number", JsonType.INTEGER: "number"}
+_HA_R_COMPONENTS = {JsonType.BOOLEAN: "binary_sensor"}
+
+
 def ha_get_component_for_prop(prop_info):
-    component = "sensor"
-    if "rw" in prop_info and prop_info["rw"] == "R/W":
+    rw = prop_info.get("rw")
+    if rw == "R/W":
         if "valueMap" in prop_info:
-            component = "select"
-        elif "jsonType" in prop_info and prop_info["jsonType"] == "boolean":
-            component = "switch"
-        elif "jsonType" in prop_info and prop_info["jsonType"] == "float":
-            component = "number"
-        elif "jsonType" in prop_info and prop_info["jsonType"] == "integer":
-            component = "number"
-    elif "rw" in prop_info and prop_info["rw"] == "R":
-        if "jsonType" in prop_info and prop_info["jsonType"] == "boolean":
-            component = "binary_sensor"
-    return component
+            return "select"
+        return _HA_RW_COMPONENTS.get(prop_info.get("_jt"), "sensor")
+    elif rw == "R":
+        return _HA_R_COMPONENTS.get(prop_info.get("_jt"), "sensor")
+    return "sensor"
 
 
 def ha_get_default_config_for_prop(prop_info):
     config = {}
-    if "rw" in prop_info and prop_info["rw"] == "R/W":
-        if "jsonType" in prop_info and \
-                (prop_info["jsonType"] == "float" or prop_info["jsonType"] == "integer"):
+    if prop_info.get("rw") == "R/W":
+        if _HA_RW_COMPONENTS.get(prop_info.get("_jt")) == "number":
             config["mode"] = "box"
-        if "category" in prop_info and prop_info["category"] == "Config":
+        if prop_info.get("category") == "Config":
             config["entity_category"] = "config"
     if "homeAssistant" not in prop_info:
         config["enabled_by_default"] = False
@@ -947,10 +1149,8 @@ def ha_get_template_filter_from_json_type(json_type):
         template = "{{ value == 'true' }}"
     return template
 
-# Publish HA discovery config for a single property
-
-
-def ha_discover_property(wp, mqtt_client, pd, disable_discovery=False, force_enablement=None):
+def ha_get_discovery_configs(wp, pd, force_enablement=None, device=None):
+    """Build (topic, component, config) tuples for the HA discovery of a property and its child properties"""
     name = pd["key"]
     ha_info = {}
     if "homeAssistant" in pd:
@@ -959,10 +1159,8 @@ def ha_discover_property(wp, mqtt_client, pd, disable_discovery=False, force_ena
     if "component" in ha_info:  # Override component from config
         component = ha_info["component"]
     _LOGGER.debug(
-        f"Homeassistant config: haInfo={ha_info}, component={component}")
+        "Homeassistant config: haInfo=%s, component=%s", ha_info, component)
     title = pd.get("title", pd.get("alias", name))
-    _LOGGER.debug(
-        f"Publishing HA discovery config for property '{name}' ...")
     ha_config = ha_info.get("config", {})
     unique_id = f"wattpilot_{wp.serial}_{name}"
     object_id = f"wattpilot_{name}"
@@ -972,7 +1170,7 @@ def ha_discover_property(wp, mqtt_client, pd, disable_discovery=False, force_ena
         "serialNumber": wp.serial,
         "uniqueId": unique_id,
     }
-    ha_device = ha_get_device_info(wp)
+    ha_device = device if device != None else ha_get_device_info(wp)
     base_topic = mqtt_subst_topic(
         Cfg.MQTT_TOPIC_PROPERTY_BASE.val, topic_subst_map, False)
     ha_discovery_config = ha_get_default_config_for_prop(pd) | {
@@ -991,31 +1189,154 @@ def ha_discover_property(wp, mqtt_client, pd, disable_discovery=False, force_ena
     if pd.get("rw", "") == "R/W":
         ha_discovery_config["command_topic"] = mqtt_subst_topic(
             Cfg.MQTT_TOPIC_PROPERTY_SET.val, topic_subst_map, False)
-    ha_discovery_config = dict(
-        list(ha_discovery_config.items())
-        + list(ha_config.items())
-    )
+    ha_discovery_config |= ha_config
     if force_enablement != None:
         ha_discovery_config["enabled_by_default"] = force_enablement
-    topic_cfg = mqtt_subst_topic(Cfg.HA_TOPIC_CONFIG.val, topic_subst_map)
-    if disable_discovery:
-        payload = ''
-    else:
-        payload = utils_value2json(ha_discovery_config)
-    _LOGGER.debug(
-        f"Publishing property '{name}' to {topic_cfg}: {payload}")
-    mqtt_client.publish(topic_cfg, payload, retain=True)
-    # Publish additional read-only sensor for special rw properties:
+    configs = [(mqtt_subst_topic(Cfg.HA_TOPIC_CONFIG.val, topic_subst_map), component, ha_discovery_config)]
+    # Additional read-only sensor for special rw properties:
     if pd.get("rw", "") == "R/W" and component != "sensor":
-        if payload != "":
-            del ha_discovery_config["command_topic"]
-            payload = utils_value2json(ha_discovery_config)
-        mqtt_client.publish(mqtt_subst_topic(Cfg.HA_TOPIC_CONFIG.val, topic_subst_map | {
-                            "component": "sensor"}), payload, retain=True)
+        configs.append((
+            mqtt_subst_topic(Cfg.HA_TOPIC_CONFIG.val, topic_subst_map | {"component": "sensor"}),
+            "sensor",
+            {k: v for k, v in ha_discovery_config.items() if k != "command_topic"},
+        ))
     if Cfg.WATTPILOT_SPLIT_PROPERTIES.val and "childProps" in pd:
         for p in pd["childProps"]:
-            ha_discover_property(wp, mqtt_client, p,
-                                 disable_discovery, force_enablement)
+            configs += ha_get_discovery_configs(wp, p, force_enablement, ha_device)
+    return configs
+
+
+# Publish HA discovery config for a single property
+
+
+def ha_discover_property(wp, mqtt_client, pd, disable_discovery=False, force_enablement=None, device=None, retained_configs=None):
+    _LOGGER.debug(
+        "Publishing HA discovery config for property '%s' ...", pd['key'])
+    msg_infos = []
+    for topic_cfg, component, config in ha_get_discovery_configs(wp, pd, force_enablement, device):
+        payload = b'' if disable_discovery else utils_value2json_bytes(config)
+        if ha_is_config_retained(retained_configs, topic_cfg, payload):
+            _LOGGER.debug(
+                "Skipping property '%s' - config already retained on %s", pd['key'], topic_cfg)
+            continue
+        _LOGGER.debug(
+            "Publishing property '%s' to %s: %s", pd['key'], topic_cfg, payload)
+        msg_infos.append(mqtt_client.publish(topic_cfg, payload, qos=1, retain=True))
+    return msg_infos
+
+
+# Publish a single device based HA discovery config for all properties
+
+
+def ha_discover_device(wp, mqtt_client, ha_properties, disable_discovery=False, retained_configs=None, removed_properties=(), force_enablement=None):
+    global wpdef
+    topic_cfg = mqtt_subst_topic(Cfg.HA_TOPIC_DEVICE_CONFIG.val, {
+        "serialNumber": wp.serial,
+    })
+    payload = b''
+    if not disable_discovery:
+        ha_device = ha_get_device_info(wp)
+        components = {}
+        for name in ha_properties:
+            for _, component, config in ha_get_discovery_configs(wp, wpdef["properties"][name], (force_enablement or {}).get(name), ha_device):
+                del config["device"]  # Shared by all components
+                components[f"{config['object_id']}_{component}"] = {"p": component} | config
+        # Components are removed by only sending their platform:
+        for name in removed_properties:
+            for _, component, config in ha_get_discovery_configs(wp, wpdef["properties"][name], None, ha_device):
+                components.setdefault(f"{config['object_id']}_{component}", {"p": component})
+        payload = utils_value2json_bytes({
+            "dev": ha_device,
+            "o": {
+                "name": "wattpilot",
+                "sw": version('wattpilot'),
+            },
+            "cmps": components,
+        })
+    if ha_is_config_retained(retained_configs, topic_cfg, payload):
+        _LOGGER.debug("Skipping device config - already retained on %s", topic_cfg)
+        return []
+    _LOGGER.debug("Publishing device config to %s: %s", topic_cfg, payload)
+    return [mqtt_client.publish(topic_cfg, payload, qos=1, retain=True)]
+
+
+def ha_is_config_retained(retained_configs, topic, payload):
+    return bool(retained_configs) and payload != b'' and \
+        retained_configs.get(topic) == hashlib.sha1(payload).digest()
+
+
+def ha_get_retained_configs(mqtt_client, wp, device_discovery=None):
+    """Collect hashes of the discovery configs currently retained on the broker by topic"""
+    retained_configs = {}
+    if device_discovery == None:
+        device_discovery = Cfg.HA_DEVICE_DISCOVERY.val
+    if device_discovery:
+        topic_filter = mqtt_subst_topic(Cfg.HA_TOPIC_DEVICE_CONFIG.val, {
+            "serialNumber": wp.serial,
+        })
+    else:
+        # Use a wildcard for each topic level depending on the property:
+        topic_filter = "/".join(["+" if "+" in t else t for t in mqtt_subst_topic(Cfg.HA_TOPIC_CONFIG.val, {
+            "component": "+",
+            "propName": "+",
+            "serialNumber": wp.serial,
+            "uniqueId": "+",
+        }).split("/")])
+
+    def on_retained_config(client, userdata, message):
+        if message.retain:
+            retained_configs[message.topic] = hashlib.sha1(message.payload).digest()
+    mqtt_client.message_callback_add(topic_filter, on_retained_config)
+    # NOTE: QoS 0 avoids the broker throttling the (possibly many) retained configs by its inflight limit:
+    mqtt_client.subscribe(topic_filter, qos=0)
+    # Retained messages are delivered right after subscribing:
+    sleep(HA_RETAINED_CONFIGS_WAIT_S)
+    mqtt_client.unsubscribe(topic_filter)
+    mqtt_client.message_callback_remove(topic_filter)
+    _LOGGER.debug(
+        "Found %s retained HA discovery configs for %s", len(retained_configs), topic_filter)
+    return dict(retained_configs)
+
+
+def ha_get_entity_config_topics(wp):
+    """Collect the per-entity discovery config topics of all properties"""
+    global wpdef
+    ha_device = ha_get_device_info(wp)
+    topics = set()
+    for pd in wpdef["properties"].values():
+        topics.update(t for t, _, _ in ha_get_discovery_configs(wp, pd, None, ha_device))
+    return topics
+
+
+def ha_migrate_entity_configs(wp, mqtt_client):
+    """Announce the migration of retained per-entity discovery configs to the device based config"""
+    retained_configs = ha_get_retained_configs(mqtt_client, wp, device_discovery=False)
+    topics = sorted(ha_get_entity_config_topics(wp).intersection(retained_configs))
+    if topics:
+        _LOGGER.info(
+            "Migrating %s per-entity HA discovery configs to the device based config ...", len(topics))
+    msg_infos = [mqtt_client.publish(topic, HA_MIGRATE_DISCOVERY_PAYLOAD, qos=1, retain=True)
+                 for topic in topics]
+    return topics, msg_infos
+
+
+def ha_subscribe_status(mqtt_client):
+    """Subscribe to the HA status topic and return an event set once HA (re-)announces itself online"""
+    ha_online = Event()
+
+    def on_ha_status(client, userdata, message):
+        # NOTE: A retained status only tells that HA was online before, not that it processed the new configs:
+        if not message.retain and message.payload == HA_STATUS_ONLINE_PAYLOAD:
+            _LOGGER.debug("Received HA birth message on %s", message.topic)
+            ha_online.set()
+    mqtt_client.message_callback_add(Cfg.HA_TOPIC_STATUS.val, on_ha_status)
+    mqtt_client.subscribe(Cfg.HA_TOPIC_STATUS.val)
+    return ha_online
+
+
+def ha_unsubscribe_status(mqtt_client):
+    mqtt_client.unsubscribe(Cfg.HA_TOPIC_STATUS.val)
+    mqtt_client.message_callback_remove(Cfg.HA_TOPIC_STATUS.val)
 
 
 def ha_is_default_prop(pd):
@@ -1029,34 +1350,42 @@ def ha_is_default_prop(pd):
 def ha_get_discovery_properties():
     global wpdef
     _LOGGER.debug(
-        f"get_ha_discovery_properties(): HA_PROPERTIES='{Cfg.HA_PROPERTIES.val}', propdef size='{len(wpdef['properties'])}'")
+        "get_ha_discovery_properties(): HA_PROPERTIES='%s', propdef size='%s'", Cfg.HA_PROPERTIES.val, len(wpdef['properties']))
     ha_properties = Cfg.HA_PROPERTIES.val
     if ha_properties == [''] or ha_properties == []:
         ha_properties = [p["key"]
                          for p in wpdef["properties"].values() if ha_is_default_prop(p)]
     _LOGGER.debug(
-        f"get_ha_discovery_properties(): ha_properties='{ha_properties}'")
+        "get_ha_discovery_properties(): ha_properties='%s'", ha_properties)
     return ha_properties
 
 
-def ha_discover_properties(mqtt_client, ha_properties, disable_discovery=True):
+def ha_discover_properties(mqtt_client, ha_properties, disable_discovery=True, retained_configs=None):
     global wpdef
     _LOGGER.info(
-        f"{'Disabling' if disable_discovery else 'Enabling'} HA discovery for the following properties: {ha_properties}")
+        "%s HA discovery for the following properties: %s", 'Disabling' if disable_discovery else 'Enabling', ha_properties)
+    if Cfg.HA_DEVICE_DISCOVERY.val:
+        return ha_discover_device(wp, mqtt_client, ha_properties, disable_discovery, retained_configs)
+    ha_device = ha_get_device_info(wp)
+    msg_infos = []
     for name in ha_properties:
-        ha_discover_property(
-            wp, mqtt_client, wpdef["properties"][name], disable_discovery)
+        msg_infos += ha_discover_property(
+            wp, mqtt_client, wpdef["properties"][name], disable_discovery, device=ha_device, retained_configs=retained_configs)
+    return msg_infos
 
 
 def ha_publish_initial_properties(wp, mqtt_client):
     global wpdef
     _LOGGER.info(
-        f"Publishing all initial property values to MQTT to populate the entity values ...")
+        "Publishing all initial property values to MQTT to populate the entity values ...")
+    publications = []
+    settings = mqtt_get_publish_settings()
     for prop_name in Cfg.HA_PROPERTIES.val:
         if prop_name in wp.allProps:
             value = wp.allProps[prop_name]
             pd = wpdef["properties"][prop_name]
-            mqtt_publish_property(wp, mqtt_client, pd, value)
+            publications += mqtt_get_property_publications(wp, pd, value, settings=settings)
+    mqtt_publish_batch(mqtt_client, publications)
 
 
 def ha_setup(wp):
@@ -1067,23 +1396,41 @@ def ha_setup(wp):
         Cfg.MQTT_PROPERTIES.val = Cfg.HA_PROPERTIES.val
     # Setup MQTT client:
     mqtt_client = mqtt_setup(wp)
-    # Publish HA discovery config:
-    ha_discover_properties(mqtt_client, Cfg.HA_PROPERTIES.val, False)
-    # Wait a bit for HA to catch up:
-    wait_time = math.ceil(
-        Cfg.HA_WAIT_INIT_S.val + len(Cfg.HA_PROPERTIES.val)*Cfg.HA_WAIT_PROPS_MS.val*0.001)
+    # Listen for HA coming online to stop waiting early:
+    ha_online = ha_subscribe_status(mqtt_client)
+    # Hand over configs from per-entity discovery to the device based config (if any):
+    migrated_topics, msg_infos = [], []
+    if Cfg.HA_DEVICE_DISCOVERY.val:
+        migrated_topics, msg_infos = ha_migrate_entity_configs(wp, mqtt_client)
+    # Publish changed HA discovery configs and wait for the broker to acknowledge them:
+    # NOTE: Migrated entities need the device config to be published again, even if unchanged:
+    retained_configs = ha_get_retained_configs(mqtt_client, wp) if not migrated_topics else None
+    msg_infos += ha_discover_properties(
+        mqtt_client, Cfg.HA_PROPERTIES.val, False, retained_configs)
+    # Clear the migrated per-entity configs (after the device config took them over):
+    msg_infos += [mqtt_client.publish(topic, b'', qos=1, retain=True) for topic in migrated_topics]
+    if not mqtt_wait_for_publish(msg_infos, Cfg.HA_DISCOVERY_TIMEOUT_S.val):
+        _LOGGER.warning(
+            "Timeout while waiting for the MQTT broker to acknowledge the HA discovery configs!")
+    # Wait a bit more for HA to catch up (if configured):
+    wait_time = Cfg.HA_WAIT_INIT_S.val + \
+        (len(Cfg.HA_PROPERTIES.val)*Cfg.HA_WAIT_PROPS_MS.val + 999)//1000
     if wait_time > 0:
         _LOGGER.info(
-            f"Waiting {wait_time}s to allow Home Assistant to discovery entities and subscribe MQTT topics before publishing initial values ...")
-        # Sleep to let HA discover the entities before publishing values
-        sleep(wait_time)
+            "Waiting %ds to allow Home Assistant to discovery entities and subscribe MQTT topics before publishing initial values ...", wait_time)
+        # Wait to let HA discover the entities before publishing values (unless HA announces itself online):
+        ha_online.wait(timeout=wait_time)
+    ha_unsubscribe_status(mqtt_client)
     # Publish initial property values to MQTT:
     ha_publish_initial_properties(wp, mqtt_client)
     return mqtt_client
 
 
 def ha_stop(mqtt_client):
-    ha_discover_properties(mqtt_client, Cfg.HA_PROPERTIES.val, True)
+    msg_infos = ha_discover_properties(mqtt_client, Cfg.HA_PROPERTIES.val, True)
+    if not mqtt_wait_for_publish(msg_infos, Cfg.HA_DISCOVERY_TIMEOUT_S.val):
+        _LOGGER.warning(
+            "Timeout while waiting for the MQTT broker to acknowledge the removal of the HA discovery configs!")
     mqtt_stop(mqtt_client)
 
 class Env():
@@ -1105,9 +1452,13 @@ class Env():
 # Wattpilot Configuration
 class Cfg(Enum):
     HA_DISABLED_ENTITIES = Env("boolean", "false", "Create disabled entities in Home Assistant")
+    HA_DEVICE_DISCOVERY = Env("boolean", "false", "Publish a single device based discovery config for all entities (requires Home Assistant 2024.11 or later) instead of one config per entity. Retained per-entity configs of a previous setup are handed over on startup using the `migrate_discovery` payload of Home Assistant and cleared afterwards")
+    HA_DISCOVERY_TIMEOUT_S = Env("integer", "10", "Wait timeout in seconds for the MQTT broker to acknowledge the discovery configs before publishing initial values")
     HA_ENABLED = Env("boolean", "false", "Enable Home Assistant Discovery")
     HA_PROPERTIES = Env("list", "", "List of space-separated properties that should be discovered by Home Assistant (leave unset for all properties having `homeAssistant` set in [wattpilot.yaml](src/wattpilot/ressources/wattpilot.yaml)")
     HA_TOPIC_CONFIG = Env("string", "homeassistant/{component}/{uniqueId}/config", "Topic pattern for HA discovery config")
+    HA_TOPIC_DEVICE_CONFIG = Env("string", "homeassistant/device/wattpilot_{serialNumber}/config", "Topic pattern for HA device based discovery config (see `HA_DEVICE_DISCOVERY`)")
+    HA_TOPIC_STATUS = Env("string", "homeassistant/status", "Topic of the HA birth message; receiving `online` ends waiting before publishing initial values (see `HA_WAIT_INIT_S` and `HA_WAIT_PROPS_MS`)")
     HA_WAIT_INIT_S = Env("integer", "0", "Wait initial number of seconds after starting discovery (in addition to wait time depending on the number of properties). May be increased, if entities in HA are not populated with values.")
     HA_WAIT_PROPS_MS = Env("integer", "0", "Wait milliseconds per property after discovery before publishing property values. May be increased, if entities in HA are not populated with values.")
     MQTT_AVAILABLE_PAYLOAD = Env("string", "online", "Payload for the availability topic in case the MQTT bridge is online")
@@ -1146,7 +1497,7 @@ class Cfg(Enum):
             d.name = var.name
             strval = env.get(var.name, d.default)
             if d.datatype == "boolean":
-                d.val = (strval == "true")
+                d.val = strval.strip().lower() in ("1", "true", "yes")
             elif d.datatype == "integer":
                 d.val = int(strval)
             elif d.datatype == "list":
@@ -1157,7 +1508,7 @@ class Cfg(Enum):
                     strval = "********"
             elif d.datatype == "string":
                 d.val = strval
-            _LOGGER.debug(f"{d.format()} (from '{strval}')")
+            _LOGGER.debug("%s (from '%s')", d.format(), strval)
             assert not d.required or d.val, f"{var.name} is not set!"
         for var in [e for e in list(cls) if e.value.requiredIf]:
             d = var.value
@@ -1182,16 +1533,27 @@ class Cfg(Enum):
 
 #### Main Program ####
 
+def main_handle_sigterm(signum, frame):
+    # NOTE: Raise SystemExit, as cmd2 swallows KeyboardInterrupt at the prompt:
+    sys.exit(128 + signum)
+
+
 def main():
     global mqtt_client
     global wp
     global wpdef
 
+    # Take a snapshot of the environment to avoid repeated os.environ lookups:
+    env = dict(os.environ)
+
     # Set debug level:
-    logging.basicConfig(level=os.environ.get('WATTPILOT_LOGLEVEL','INFO').upper())
+    logging.basicConfig(level=env.get('WATTPILOT_LOGLEVEL','INFO').upper())
 
     # Setup environment variables:
-    Cfg.set(os.environ)
+    Cfg.set(env)
+
+    # Exit on SIGTERM (e.g. when stopping a container), so that MQTT is stopped gracefully:
+    signal.signal(signal.SIGTERM, main_handle_sigterm)
 
     # Initialize globals:
     mqtt_client = None
@@ -1200,25 +1562,31 @@ def main():
 
     # Initialize shell:
     wpsh = WattpilotShell(wp, wpdef)
-    if Cfg.WATTPILOT_AUTOCONNECT.val:
-        _LOGGER.info("Automatically connecting to Wattpilot ...")
-        wpsh.do_connect("")
-        # Enable MQTT and/or HA integration:
-        if Cfg.MQTT_ENABLED.val and not Cfg.HA_ENABLED.val:
-            wpsh.do_mqtt("start")
-        elif Cfg.MQTT_ENABLED.val and Cfg.HA_ENABLED.val:
-            wpsh.do_ha("start")
-        wpsh.do_info("")
-    if len(sys.argv) < 2:
-        wpsh.cmdloop()
-    else:
-        wpsh.onecmd(sys.argv[1])
+    try:
+        if Cfg.WATTPILOT_AUTOCONNECT.val:
+            _LOGGER.info("Automatically connecting to Wattpilot ...")
+            wpsh.do_connect("")
+            # Enable MQTT and/or HA integration:
+            if Cfg.MQTT_ENABLED.val and not Cfg.HA_ENABLED.val:
+                wpsh.do_mqtt("start")
+            elif Cfg.MQTT_ENABLED.val and Cfg.HA_ENABLED.val:
+                wpsh.do_ha("start")
+            wpsh.do_info("")
+        if len(sys.argv) < 2:
+            wpsh.cmdloop()
+        else:
+            wpsh.onecmd(sys.argv[1])
+    finally:
+        # Let pending MQTT messages reach the broker before exiting:
+        if mqtt_client != None:
+            mqtt_stop(mqtt_client)
 
 
 if __name__ == '__main__':
     try:
         main()
     except KeyboardInterrupt:
+        # NOTE: MQTT is already stopped by main():
         try:
             sys.exit(0)
         except SystemExit: